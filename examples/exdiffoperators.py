@@ -4,7 +4,7 @@
 # Some examples on the use of differential operators in the sphere
 # Jon Saenz, 20000215
 from Scientific.IO.NetCDF import *
-from numpy.oldnumeric import *
+from numpy import *
 
 from pyclimate.diffoperators import *
 
@@ -28,8 +28,8 @@ shape=ihgt.shape[1:]
 levels=ihgt.shape[1]
 
 # Read the input records, get the geostrophic wind
-lats=array(inc.variables["lat"][:],Float64)
-lons=array(inc.variables["lon"][:],Float64)
+lats=array(inc.variables["lat"][:],float64)
+lons=array(inc.variables["lon"][:],float64)
 R=6.37e6
 hgrad=HGRADIENT(lats,lons,R)
 hdiv=HDIVERGENCE(lats,lons,R)
@@ -39,14 +39,14 @@ omega=7.292e-5
 kgeo=g/2./omega/sin(deg2rad(lats))
 print "Average of geostrophic wind and divergence of geostrophic wind"
 for irec in xrange(records):
-	hgtfield=array(ihgt[irec],Float64)
-	ugwind=zeros(shape,Float64)
-	vgwind=zeros(shape,Float64)
-	gdiv=zeros(shape,Float64)
+	hgtfield=array(ihgt[irec],float64)
+	ugwind=zeros(shape,float64)
+	vgwind=zeros(shape,float64)
+	gdiv=zeros(shape,float64)
 	for ilev in xrange(levels):
 		thegrad=hgrad.hgradient(hgtfield[ilev,:,:])
-		ucomp=-kgeo[:,NewAxis]*thegrad[1]
-		vcomp=kgeo[:,NewAxis]*thegrad[0]
+		ucomp=-kgeo[:,newaxis]*thegrad[1]
+		vcomp=kgeo[:,newaxis]*thegrad[0]
 		ugwind[ilev,:,:]=ucomp
 		vgwind[ilev,:,:]=vcomp
 		gdiv[ilev,:,:]=hdiv.hdivergence(ucomp,vcomp)
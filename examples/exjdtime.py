@@ -5,7 +5,7 @@
 from pyclimate.JDTime import *
 from pyclimate.JDTimeHandler import *
 from Scientific.IO.NetCDF import *
-from numpy.oldnumeric import *
+from numpy import *
 
 
 # Instance of Julian Day structure
@@ -17,7 +17,7 @@ jd0=date2jd(jdt)
 # Create an exact monthly interval in an output netCDF file
 onc=NetCDFFile('times.nc','w')
 onc.createDimension('time',None)
-ovar=onc.createVariable('time',Float64,('time',))
+ovar=onc.createVariable('time',float64,('time',))
 ovar.units='hours since %4.4d-%2.2d-%2.2d 0:0:0'%date0
 tstep=monthlystep()*24.
 for orec in xrange(200):
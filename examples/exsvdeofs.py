@@ -2,7 +2,7 @@
 # exsvdeofs.py
 #
 # Example on the use of svdeofs.py
-from numpy.oldnumeric import *
+from numpy import *
 from pyclimate.svdeofs import *
 from pyclimate.readdat import *
 from pyclimate.mvarstatools import *
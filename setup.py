@@ -22,6 +22,8 @@ setup (name = "PyClimate",
                                  'src/pydcdflib_wrap.c',
                                  'src/dcdflib.c']) ,
                        Extension('pyclimate.KPDF',['src/KPDF.c']),
+                       Extension('pyclimate.analogknn',
+                                ['src/analogknn.c']),
                        Extension('pyclimate.anumhist',['src/anumhist.c'])],
 #	py_modules = ["pyclimate.JDTime","pyclimate.JDTimeHandler",
 #                      "pyclimate.KZFilter",
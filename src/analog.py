@@ -34,18 +34,31 @@
 # jff20010621
 
 import numpy
+try:
+  from scipy.spatial import cKDTree
+  from scipy.spatial.distance import cdist
+except ImportError:
+  cKDTree = None
+  cdist = None
+try:
+  from pyclimate import analogknn
+except ImportError:
+  analogknn = None
+
+# Above this many (records x neighbours) entries the streamed C kernel
+# beats building any full distance matrix
+_KNNCTHRESHOLD = 1 << 18
 import pyclimate.tools
 import pyclimate.mvarstatools
 import pyclimate.svdeofs
 import pyclimate.bpcca
 import pyclimate.pyclimateexcpt
-import math, os
+import math
+from datetime import datetime
 
 ptools = pyclimate.tools
 pmvstools = pyclimate.mvarstatools
 pex = pyclimate.pyclimateexcpt
-def mm(array1,array2):
-  return numpy.matrix(array1)*numpy.matrix(array2)
 NA = numpy.newaxis
 
 def get_weights(distarray,weightexp):
@@ -62,10 +75,13 @@ def get_weights(distarray,weightexp):
 
     'weightexp' -- The exponent of the weights.
   """
-  rval = distarray ** weightexp
-  rval = 1./rval
-  rval = rval / numpy.add.reduce(rval,1)[:,NA]
-  return rval 
+  if weightexp == 2.0:
+    # Common case: avoid the libm pow call altogether
+    rval = 1./(distarray*distarray)
+  else:
+    rval = numpy.power(distarray, -float(weightexp))
+  rval /= numpy.add.reduce(rval,1)[:,NA]
+  return rval
 
 class __ANALOG:            
   """Base class for the analog search. It cannot be instanciated!
@@ -83,26 +99,162 @@ class __ANALOG:
 
   'getCoords(pattern)' -- which gives the coordinates of 'pattern' in a given metric. 
   """       
+  def _buildSearchIndex(self):
+    """Builds the nearest neighbour index over the library coordinates
+
+    When scipy is available and the search space has enough dimensions
+    a kd-tree over 'P' is built once here, so every query is
+    O(log L) instead of a full O(L) scan. In very low dimensional
+    spaces (or without scipy) the brute force kernel wins and is kept
+    as the fallback.
+    """
+    self._rankingdata()
+    if cKDTree is not None and self.P.shape[1] >= 4:
+      self._searchtree = cKDTree(numpy.ascontiguousarray(self.P))
+    else:
+      self._searchtree = None
+
+  def _rankingdata(self):
+    """float32 copies of 'P' and its squared norms, cached on first use
+
+    Ranking nearest analogs only needs the relative order of the
+    distances, which survives single precision at these condition
+    numbers, so the bulk distance scan streams half the bytes. The
+    true (float64) squared distances are recovered afterwards for the
+    few selected records only.
+    """
+    try:
+      return self.P32, self._Psqnorms32
+    except AttributeError:
+      self.P32 = numpy.ascontiguousarray(self.P, numpy.float32)
+      self._Psqnorms32 = numpy.add.reduce(self.P32 * self.P32, 1)
+      return self.P32, self._Psqnorms32
+
+  def _sqdistances32(self, thecoords):
+    """Approximate squared distances (float32, shifted by -||q||^2)
+
+    Expanded square ||q-P||^2 = ||q||^2 + ||P||^2 - 2 q.P: only a
+    length L vector is allocated (no (L, neofs) temporary), the cross
+    term is a BLAS dot product and the ||q||^2 constant is dropped
+    since it does not alter the ranking.
+    """
+    P32, Psqnorms32 = self._rankingdata()
+    return Psqnorms32 - numpy.float32(2.)*numpy.dot(P32, thecoords.astype(numpy.float32))
+
   def findAnalogRecord(self, field):
     "Returns the index in 'dataset' of the analog for the field 'field'"
-    thecoords = self.getCoords(field) 
-    sqres = thecoords[NA,:] - self.P
-    sqres = sqres * sqres
-    sqres = numpy.add.reduce(sqres,1)
-    theindex = numpy.argmin(sqres)
-    self.sqres = sqres[theindex]
+    thecoords = self.getCoords(field)
+    tree = getattr(self, "_searchtree", None)
+    if tree is not None:
+      dist, theindex = tree.query(thecoords, k=1)
+      self.sqres = dist * dist
+      return int(theindex)
+    if cdist is not None:
+      sqres = cdist(thecoords[NA,:], self.P, 'sqeuclidean')[0]
+    else:
+      sqres = self._sqdistances32(thecoords)
+    theindex = int(numpy.argmin(sqres))
+    residual = self.P[theindex] - thecoords
+    self.sqres = numpy.dot(residual, residual)
     return theindex
 
   def findNAnalogRecords(self, field, n):
     "Returns the 'n' indices in 'dataset' of the 'n' nearest analogs for 'field'"
-    thecoords = self.getCoords(field) 
-    sqres = thecoords[NA,:] - self.P
-    sqres = sqres * sqres
-    sqres = numpy.add.reduce(sqres,1)
-    theindices = numpy.argsort(sqres).tolist()[:n] 
-    self.sqres = numpy.array(numpy.take(sqres, theindices))
+    thecoords = self.getCoords(field)
+    tree = getattr(self, "_searchtree", None)
+    if tree is not None:
+      # Query with a 2-d pattern and take row 0: for k=1 a 1-d query
+      # would squeeze the answer down to bare scalars. Clip 'n' to the
+      # library size, since query() pads missing neighbours with inf
+      # distances and out of range indices
+      dists, theindices = tree.query(thecoords[NA,:], k=min(n,len(self.P)))
+      dists = numpy.atleast_1d(dists[0])
+      theindices = numpy.atleast_1d(theindices[0]).astype(numpy.intp)
+      self.sqres = dists * dists
+      return theindices
+    if analogknn is not None and len(self.P) * n > _KNNCTHRESHOLD:
+      # Streamed C kernel: one pass over the library with a k-heap,
+      # no length L distance vector at all
+      theindices, sqsel = analogknn.KnnSqEuclidean(thecoords[NA,:], self.P, n)
+      self.sqres = sqsel[0]
+      return theindices[0]
+    if cdist is not None:
+      sqres = cdist(thecoords[NA,:], self.P, 'sqeuclidean')[0]
+    else:
+      sqres = self._sqdistances32(thecoords)
+    if n < len(sqres):
+      # O(L + n log n): select the n nearest, then sort only those
+      part = numpy.argpartition(sqres, n)[:n]
+      theindices = part[numpy.argsort(numpy.take(sqres, part))]
+    else:
+      theindices = numpy.argsort(sqres)[:n]
+    residuals = numpy.take(self.P, theindices, 0) - thecoords[NA,:]
+    self.sqres = numpy.add.reduce(residuals * residuals, 1)
     return theindices
 
+  def getCoordsBatch(self, fields):
+    """Coordinates of several fields (along the _first_ axis) at once
+
+    All the fields are projected through '_projmatrix' with a single
+    matrix-matrix product instead of one matrix-vector product each.
+    """
+    if fields.shape[1:] != self.originalshape:
+      raise pex.ANALOGNoMatchingShape(fields.shape[1:], self.originalshape)
+    flatfields = numpy.asarray(fields).reshape((len(fields), -1))
+    return numpy.dot(flatfields, self._projmatrix)
+
+  def _nearestRecords(self, patterns, smoothing, maxcache=50):
+    """Indices and distances of the nearest records for all 'patterns'
+
+    The search is resolved once for up to 'maxcache' neighbours per
+    pattern and cached keyed on the identity of 'patterns', so
+    repeated selections over the same base patterns -- the usual sweep
+    over several 'smoothing' values -- just slice the cached result.
+    """
+    try:
+      cache = self._nncache
+    except AttributeError:
+      cache = self._nncache = {}
+    cached = cache.get(id(patterns))
+    # The entry keeps a reference to the patterns array itself: ids
+    # of dead objects get recycled, so a hit is only trusted if the
+    # stored array is the very object the caller passed
+    if cached is not None and cached[0] is not patterns:
+      cached = None
+    if cached is None or cached[1].shape[1] < smoothing:
+      depth = min(max(smoothing, maxcache), len(self.P))
+      Q = self.getCoordsBatch(patterns)
+      if analogknn is not None and len(self.P) * depth > _KNNCTHRESHOLD:
+        # Streamed C kernel: the (patterns, library) distance matrix is
+        # never built, only the (patterns, depth) winners are kept
+        nearest, sqsel = analogknn.KnnSqEuclidean(Q, self.P, depth)
+        cached = (patterns, nearest.astype(numpy.intp), numpy.sqrt(sqsel))
+        cache[id(patterns)] = cached
+        return cached[1][:,:smoothing], cached[2][:,:smoothing]
+      if cdist is not None:
+        # C kernel, no (patterns, library, neofs) intermediate
+        sqdists = cdist(Q, self.P, 'sqeuclidean')
+      else:
+        # Rank in float32 -- half the streamed bytes; exact distances
+        # are recovered below in float64 for the selected records only
+        P32, Psqnorms32 = self._rankingdata()
+        Q32 = Q.astype(numpy.float32)
+        Qsqnorms = numpy.add.reduce(Q32 * Q32, 1)
+        sqdists = Qsqnorms[:,NA] + Psqnorms32[NA,:] - numpy.float32(2.)*numpy.dot(Q32, numpy.transpose(P32))
+      rows = numpy.arange(len(patterns))[:,NA]
+      if depth < sqdists.shape[1]:
+        nearest = numpy.argpartition(sqdists, depth, axis=1)[:,:depth]
+      else:
+        nearest = numpy.argsort(sqdists, axis=1)[:,:depth]
+      # Sort just the 'depth' selected columns of each row
+      order = numpy.argsort(sqdists[rows,nearest], axis=1)
+      nearest = nearest[rows,order].astype(numpy.intp)
+      residuals = numpy.take(self.P, nearest, 0) - Q[:,NA,:]
+      distances = numpy.sqrt(numpy.add.reduce(residuals * residuals, 2))
+      cached = (patterns, nearest, distances)
+      cache[id(patterns)] = cached
+    return cached[1][:,:smoothing], cached[2][:,:smoothing]
+
   def __len__(self):
     "Number of records in the library 'dataset'"
     return len(self.dataset)
@@ -138,18 +290,20 @@ class EOFANALOG(__ANALOG):
     self.E = self.EOFobj.eofs(self.pcscaling)[...,:self.neofs]
     self.flatE = numpy.array(self.E[...,:])
     self.flatE.shape = (self.EOFobj.channels, self.neofs)
+    # Scaled projection basis, computed once instead of per getCoords call
+    self._invEoverL = self.flatE / self.L[NA,:]
+    # Projection matrix used by the (batched) searches
+    if self.pcscaling == 0:
+      self._projmatrix = self.flatE
+    else:
+      self._projmatrix = self._invEoverL
+    self._buildSearchIndex()
 
   def getCoords(self, field):
     "Returns the coordinates of 'field' in the PCA space"
     if field.shape != self.originalshape:
       raise pex.ANALOGNoMatchingShape(field.shape, self.originalshape)
-    field = numpy.ravel(field)
-    field.shape = (1, len(field))
-    if self.pcscaling == 0:
-      return numpy.ravel(mm(field, self.flatE)) 
-    elif self.pcscaling == 1:
-      inverseEtranspose = self.flatE / self.L[NA,:]
-      return numpy.ravel(mm(field, inverseEtranspose))
+    return numpy.dot(numpy.asarray(field).reshape(-1), self._projmatrix)
 #######################################
 # Backward compatibility definitions  #
 # Do not use!                         #
@@ -187,17 +341,18 @@ class CCAANALOG(__ANALOG):
     if not self.spherized:
       self.P = self.P * (self.CCAobj.corr**2)[NA,:]
     self.retainedeofs = (self.CCAobj.n1,self.CCAobj.n2)
+    # Projection matrix used by the (batched) searches, with the
+    # inverse correlation scaling folded in when not spherized
+    self._projmatrix = numpy.array(self.CCAobj.p_adjoint)
+    if not self.spherized:
+      self._projmatrix = self._projmatrix * (self.CCAobj.corr**2)[NA,:]
+    self._buildSearchIndex()
 
   def getCoords(self, field):
     "Returns the coordinates of 'field' in the CCA space"
     if field.shape != self.originalshape:
       raise pex.ANALOGNoMatchingShape(field.shape, self.originalshape)
-    rval = numpy.ravel(field)
-    rval.shape = (1, len(rval))
-    rval = numpy.ravel(mm(rval, self.CCAobj.p_adjoint))
-    if not self.spherized:
-      rval = rval * self.CCAobj.corr**2
-    return rval
+    return numpy.dot(numpy.asarray(field).reshape(-1), self._projmatrix)
 
 class ANALOGSelector:
   "Reconstructs a field averaging over several analog patterns"
@@ -233,21 +388,18 @@ class ANALOGSelector:
     self.patterns = patterns
     self.patternlenght = len(self.patterns)
     self.smoothing = smoothing
-    self.analogrecords = []
-    distances = numpy.zeros((self.patternlenght,self.smoothing), 'd')
-    self.weights = numpy.zeros((self.patternlenght,self.smoothing), 'd')
-    for irec in range(len(self.patterns)):
-      analogidx = ANALOGobj.findNAnalogRecords(
-        self.patterns[irec], 
-        self.smoothing
-      )
-      distances[irec] = numpy.sqrt(ANALOGobj.sqres)
-      self.analogrecords = self.analogrecords + analogidx
+    # All the patterns are searched at once (one projection GEMM plus
+    # one batched distance scan), resolved and cached by the analog
+    # object so several selectors over the same patterns share it
+    self.analogrecords, distances = ANALOGobj._nearestRecords(
+      self.patterns,
+      self.smoothing
+    )
     self.weights = get_weights(distances, weightexp)
     if report: 
       freport = open(report,"w")
       freport.write("Analog report\n")
-      freport.write(os.popen("date").read()+"\n")
+      freport.write(datetime.now().strftime("%a %b %d %H:%M:%S %Y")+"\n")
       freport.write("%s\n" % ((3+20*smoothing)*"-",))
       freport.write("idx distance[weight](analogidx)\n")
       freport.write("%s\n" % ((3+20*smoothing)*"-",))
@@ -257,7 +409,7 @@ class ANALOGSelector:
           freport.write(" %7.3f[%5.3f](%3d)" % (
             distances[irec,i],
             self.weights[irec,i],
-            self.analogrecords[self.smoothing*irec+i] + 1
+            self.analogrecords[irec,i] + 1
           ))
         freport.write("\n")
       freport.close()
@@ -272,12 +424,11 @@ class ANALOGSelector:
                  of the library dataset.
 
     """
-    if not field: field = self.ANALOGobj.dataset 
-    aanalogrecords = numpy.array(self.analogrecords)
-    ave = numpy.zeros((self.patternlenght,)+field.shape[1:], 'd')
-    for i in range(self.smoothing):
-      ave = ave + numpy.take(field,aanalogrecords[i::self.smoothing])
-    return ave / float(self.smoothing)
+    if field is None:
+      field = self.ANALOGobj.dataset
+    # One gather of shape (patterns, smoothing, ...) and one reduction
+    picked = numpy.take(field, self.analogrecords, 0)
+    return numpy.add.reduce(picked, 1) / float(self.smoothing)
 
   def returnWeightedAverage(self, field=None):
     """Returns the weighted average reconstructed field
@@ -289,15 +440,11 @@ class ANALOGSelector:
                  of the library dataset.
 
     """
-    field = field or self.ANALOGobj.dataset 
-    aanalogrecords = numpy.array(self.analogrecords)
-    ave = numpy.zeros((self.patternlenght,)+field.shape[1:], 'd')
-    for i in range(self.smoothing):
-      ave = (ave + 
-        numpy.take(field,aanalogrecords[i::self.smoothing],0) *
-        numpy.reshape(self.weights[:,i], (self.patternlenght,)+len(field.shape[1:])*(1,))
-      )
-    return ave 
+    if field is None:
+      field = self.ANALOGobj.dataset
+    # One gather plus a fused weighted reduction over the analogs
+    picked = numpy.take(field, self.analogrecords, 0)
+    return numpy.einsum('ps...,ps->p...', picked, self.weights)
    
   def returnAnalogs(self, field=None):
     """Returns the single analog (smoothing=1) reconstructed field 
@@ -314,14 +461,15 @@ class ANALOGSelector:
                  of the library dataset.
 
     """
-    field = field or self.ANALOGobj.dataset
+    if field is None:
+      field = self.ANALOGobj.dataset
     if len(field) != len(self.ANALOGobj.dataset):
       raise pex.ANALOGNoMatchingLength(len(field),len(self.ANALOGobj.dataset))
-    return numpy.take(field,self.analogrecords)
+    return numpy.take(field, numpy.ravel(self.analogrecords), 0)
   
   def __getitem__(self, idx):
     "Slide access to the analog record indices"
-    return self.analogrecords[idx*self.smoothing:(idx+1)*self.smoothing]
+    return self.analogrecords[idx]
 
 #######################################
 # Backward compatibility definitions. #
@@ -0,0 +1,185 @@
+/****************
+
+		 analogknn.c
+
+    k nearest analogs in C. It streams the library matrix row by row
+    keeping a per-query heap of the k best candidates, so the full
+    (queries x library) distance matrix is never built. This bounds the
+    memory of the analog search at queries*k*8 bytes no matter how long
+    the library is.
+
+    Copyright (C) Jon Saenz, Jesus Fernandez and Juan Zubillaga, 2001.
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+***************/
+#include "Python.h"
+#include "numpy/arrayobject.h"
+
+#include <math.h>
+#include <stdlib.h>
+
+/* Forward declaration for the method initialization table */
+static PyObject *KnnSqEuclidean( PyObject *self , PyObject *args );
+
+static PyMethodDef analogknnMethods[]={
+  {"KnnSqEuclidean",KnnSqEuclidean,METH_VARARGS},
+  {NULL,NULL} /* Last entry */
+};
+
+void initanalogknn( void )
+{
+  /* Initialize the Python Module */
+  Py_InitModule("analogknn",analogknnMethods);
+  /* Give access to numpy Arrays */
+  import_array();
+}
+
+/****
+A binary max-heap on the squared distances, with the record indices
+moved along. The root (worst candidate kept so far) is replaced as soon
+as a closer record shows up, so each library row costs one comparison
+plus a log(k) sift in the worst case.
+****/
+static void siftdown( double *d2, long *idx, int k, int root )
+{
+  int child;
+  double dtmp;
+  long itmp;
+
+  while(2*root+1<k){
+    child=2*root+1;
+    if ((child+1<k)&&(d2[child+1]>d2[child]))
+      child++;
+    if (d2[child]<=d2[root])
+      break;
+    dtmp=d2[root]; d2[root]=d2[child]; d2[child]=dtmp;
+    itmp=idx[root]; idx[root]=idx[child]; idx[child]=itmp;
+    root=child;
+  }
+}
+
+/****
+Heapsort the k kept candidates in place. Popping the maximum of the
+max-heap to the tail repeatedly leaves the squared distances in
+ascending order, which is what the Python callers expect.
+****/
+static void heapsortk( double *d2, long *idx, int k )
+{
+  int i;
+  double dtmp;
+  long itmp;
+
+  for(i=k-1;i>0;i--){
+    dtmp=d2[0]; d2[0]=d2[i]; d2[i]=dtmp;
+    itmp=idx[0]; idx[0]=idx[i]; idx[i]=itmp;
+    siftdown(d2,idx,i,0);
+  }
+}
+
+/*****
+Calling order:
+1st argument: Query coordinates (2-D NumPy array, queries x dims)
+2nd argument: Library coordinates (2-D NumPy array, records x dims)
+3rd argument: Number of neighbours k
+Returns the tuple (indices, squared distances), both (queries x k),
+each row sorted by increasing distance.
+ ***/
+static PyObject *KnnSqEuclidean( PyObject *self , PyObject *args )
+{
+  PyObject *Qo, *Po;
+  PyArrayObject *Q, *P, *ridx, *rd2;
+  int k;
+  int nq, nl, nd, iq, il, id, i;
+  int dims[2];
+  double *qrow, *prow, *d2;
+  long *idx;
+  double dist, diff;
+
+  if (!PyArg_ParseTuple(args,"OOi",&Qo,&Po,&k))
+    return NULL;
+  Q=(PyArrayObject*)PyArray_ContiguousFromObject(Qo,PyArray_DOUBLE,2,2);
+  if (Q==NULL)
+    return NULL;
+  P=(PyArrayObject*)PyArray_ContiguousFromObject(Po,PyArray_DOUBLE,2,2);
+  if (P==NULL){
+    Py_DECREF(Q);
+    return NULL;
+  }
+  nq=Q->dimensions[0];
+  nl=P->dimensions[0];
+  nd=P->dimensions[1];
+  if (Q->dimensions[1]!=nd){
+    PyErr_SetString(PyExc_TypeError,"KnnSqEuclidean: query and library dimensions do not match");
+    Py_DECREF(Q);
+    Py_DECREF(P);
+    return NULL;
+  }
+  if ((k<1)||(k>nl)){
+    PyErr_SetString(PyExc_ValueError,"KnnSqEuclidean: k must verify 1<=k<=records");
+    Py_DECREF(Q);
+    Py_DECREF(P);
+    return NULL;
+  }
+  dims[0]=nq;
+  dims[1]=k;
+  ridx=(PyArrayObject*)PyArray_FromDims(2,dims,PyArray_LONG);
+  rd2=(PyArrayObject*)PyArray_FromDims(2,dims,PyArray_DOUBLE);
+  if ((ridx==NULL)||(rd2==NULL)){
+    Py_DECREF(Q);
+    Py_DECREF(P);
+    Py_XDECREF(ridx);
+    Py_XDECREF(rd2);
+    return NULL;
+  }
+  for(iq=0;iq<nq;iq++){
+    qrow=(double*)(Q->data+iq*Q->strides[0]);
+    idx=(long*)(ridx->data+iq*ridx->strides[0]);
+    d2=(double*)(rd2->data+iq*rd2->strides[0]);
+    /* Seed the heap with the first k library records */
+    for(i=0;i<k;i++){
+      prow=(double*)(P->data+i*P->strides[0]);
+      dist=0.;
+      for(id=0;id<nd;id++){
+	diff=qrow[id]-prow[id];
+	dist+=diff*diff;
+      }
+      d2[i]=dist;
+      idx[i]=i;
+    }
+    for(i=k/2-1;i>=0;i--)
+      siftdown(d2,idx,k,i);
+    /* Stream the remaining records through the heap */
+    for(il=k;il<nl;il++){
+      prow=(double*)(P->data+il*P->strides[0]);
+      dist=0.;
+      for(id=0;id<nd;id++){
+	diff=qrow[id]-prow[id];
+	dist+=diff*diff;
+	if (dist>=d2[0])
+	  break;
+      }
+      if (dist<d2[0]){
+	d2[0]=dist;
+	idx[0]=il;
+	siftdown(d2,idx,k,0);
+      }
+    }
+    heapsortk(d2,idx,k);
+  }
+  Py_DECREF(Q);
+  Py_DECREF(P);
+  return Py_BuildValue("(NN)",ridx,rd2);
+}
@@ -26,12 +26,45 @@ import math,sys
 def deg2rad(d):
 	"Converts degrees to radians"
 	return math.pi*d/180.
- 
-# Gradient of a scalar 2-D horizontal field
-class HGRADIENT:
-	"Horizontal gradient operator"
+
+def _cachedbuffer(obj,name,shape):
+	"Returns a scratch array cached on 'obj' as 'name', reallocating on shape change"
+	buf=getattr(obj,name,None)
+	if buf is None or buf.shape!=shape:
+		buf=numpy.empty(shape,numpy.float64)
+		setattr(obj,name,buf)
+	return buf
+
+def _centereddiff(x,out,periodic=0,axis=-1):
+	"""Centered differences of 'x' along 'axis', written into 'out'
+
+	The field is padded once along 'axis' ('wrap' for periodic
+	boundaries, 'edge' otherwise) so the whole derivative is a single
+	slice subtraction with no boundary branches. With 'edge' padding
+	the boundary rows come out as plain one-sided differences and are
+	doubled afterwards to keep the 2*(x[1]-x[0]) convention.
+	"""
+	axis=axis%len(x.shape)
+	pads=[(0,0)]*len(x.shape)
+	pads[axis]=(1,1)
+	xp=numpy.pad(x,pads,mode=periodic and 'wrap' or 'edge')
+	xs=numpy.swapaxes(xp,axis,-1)
+	outs=numpy.swapaxes(out,axis,-1)
+	numpy.subtract(xs[...,2:],xs[...,:-2],outs)
+	if not periodic:
+		outs[...,0]*=2.
+		outs[...,-1]*=2.
+	return out
+
+class _HOPERATOR:
+	"""Base class for the horizontal differential operators
+
+	It holds the grid increments, the cosine of the latitudes and the
+	memoised combined scale factors shared by the gradient, divergence
+	and curl operators.
+	"""
 	def __init__(self,lats,lons,asdegrees=1,PBlon=0):
-		"""Constructor for the class HGRADIENT
+		"""Constructor for the horizontal differential operators
 
 		Arguments:
 
@@ -62,7 +95,29 @@ class HGRADIENT:
 			self.clats=numpy.cos(lats)
 		# Periodic boundaries in latitude/longitude
 		self.PBlon=PBlon
+		# Broadcast-ready cos(lat) column and its reciprocal, built
+		# once so no method pays a reshape or divide pass per call
+		self._clatcol=self.clats[:,numpy.newaxis]
+		self._invclatcol=1./self._clatcol
+		self._scaleR=None
+
+	def _scales(self,R):
+		"""Combined scale factors for the radius 'R' (memoised)
+
+		Returns the tuple (uscale, vscale) where 'uscale' is the
+		(nlat, 1) per-latitude factor 1/(2 dlon R cos(lat)) and
+		'vscale' the scalar 1/(2 dlat R), recomputed only when 'R'
+		changes between calls.
+		"""
+		if self._scaleR!=R:
+			self._uscale=(1./(2.*self.dlon*R))*self._invclatcol
+			self._vscale=1./(2.*self.dlat*R)
+			self._scaleR=R
+		return self._uscale,self._vscale
 
+# Gradient of a scalar 2-D horizontal field
+class HGRADIENT(_HOPERATOR):
+	"Horizontal gradient operator"
 	def hgradient(self,phi,R=6.37e6):
 		"""Horizontal gradient
 
@@ -77,64 +132,42 @@ class HGRADIENT:
 				radius of the Earth 6.37e6)
 		"""
 		# Centered differences for each of the fields
-		u=numpy.zeros(phi.shape,numpy.float64)
-		v=numpy.zeros(phi.shape,numpy.float64)
-		# Longitudinal directions
-		u[...,1:-1]=phi[...,2:]-phi[...,:-2]
-		if not self.PBlon:
-			u[...,0]=2*(phi[...,1]-phi[...,0])
-			u[...,-1]=2*(phi[...,-1]-phi[...,-2])
-		else:
-			u[...,0]=(phi[...,1]-phi[...,-1])
-			u[...,-1]=(phi[...,0]-phi[...,-2])
-		# Meridional directions
-		v[...,1:-1,:]=phi[...,2:,:]-phi[...,:-2,:]
-		v[...,0,:]=2*(phi[...,1,:]-phi[...,0,:])
-		v[...,-1,:]=2*(phi[...,-1,:]-phi[...,-2,:])
-		# Divide by the increments
-		u=u/(2.*self.dlon*R)
-		v=v/(2.*self.dlat*R)
-		# Now, divide u by cos(lat)
-		u=u/self.clats[:,numpy.newaxis]
+		u=numpy.empty(phi.shape,numpy.float64)
+		v=numpy.empty(phi.shape,numpy.float64)
+		_centereddiff(phi,u,self.PBlon,axis=-1)
+		_centereddiff(phi,v,0,axis=-2)
+		# Fused scaling: the increments, the radius and the cos(lat)
+		# factor are combined once per R in a single pass per component
+		uscale,vscale=self._scales(R)
+		u*=uscale
+		v*=vscale
 		return (u,v)
 
 
-# Get the divergence of a vectorial 2-D field
-class HDIVERGENCE:
-	"Divergence operator"
-	def __init__(self,lats,lons,asdegrees=1,PBlon=0):
-		"""Constructor for the class HDIVERGENCE
-
-		Arguments:
-
-			'lats' -- Array of latitudes
-
-			'lons' -- Array of longitudes
+	def hgradient_chunked(self,phi,R=6.37e6,chunklen=32):
+		"""Horizontal gradient evaluated in chunks along the first axis
 
-		Optional Arguments:
-
-			'asdegrees' -- Bit parameter indicating wether
-				'lats' and 'lons' are passed as degrees
-				(default, 1) or not (radians, 0).
+		Intended for long time series: 'phi' only needs to support
+		slicing along its first (time) dimension, so netCDF variables
+		or memory-mapped arrays can be streamed through the kernel
+		'chunklen' records at a time, bounding the scratch memory to
+		one chunk instead of the whole series.
 
-			'PBlon' -- Bit parameter indicating the
-				use of periodic boundary conditions in
-				longitude. Defaults to 0 (no PB).
-                """
-		# These are the latitude/longitude increments
-		if asdegrees:
-			self.dlon=deg2rad(lons[1]-lons[0])
-			self.dlat=deg2rad(lats[1]-lats[0])
-			# This array holds the cosine of the latitudes
-			self.clats=numpy.cos(deg2rad(lats))
-		else:
-			self.dlon=lons[1]-lons[0]
-			self.dlat=lats[1]-lats[0]
-			# This array holds the cosine of the latitudes
-			self.clats=numpy.cos(lats)
-		# Periodic boundaries in latitude/longitude
-		self.PBlon=PBlon
+		Arguments and output match 'hgradient'.
+		"""
+		theshape=(len(phi),)+phi[0].shape
+		u=numpy.empty(theshape,numpy.float64)
+		v=numpy.empty(theshape,numpy.float64)
+		for start in xrange(0,theshape[0],chunklen):
+			chunk=numpy.asarray(phi[start:start+chunklen])
+			cu,cv=self.hgradient(chunk,R)
+			u[start:start+chunklen]=cu
+			v[start:start+chunklen]=cv
+		return (u,v)
 
+# Get the divergence of a vectorial 2-D field
+class HDIVERGENCE(_HOPERATOR):
+	"Divergence operator"
 	def hdivergence(self,u,v,R=6.37e6):
 		"""Horizontal field divergence 
 
@@ -151,67 +184,45 @@ class HDIVERGENCE:
 			'R' -- The radius of the sphere. (Defaults to the
 				radius of the Earth 6.37e6)
 		"""
-		# Multiply each row of the v component by cosine(lat)
-		dummy=numpy.array(v)*self.clats[:,numpy.newaxis]
-		# Centered differences for each of the fields
-		cdifu=numpy.zeros(u.shape,numpy.float64)
-		cdifv=numpy.zeros(v.shape,numpy.float64)
-		# Longitudinal directions
-		cdifu[...,1:-1]=u[...,2:]-u[...,:-2]
-		if not self.PBlon:
-			cdifu[...,0]=2*(u[...,1]-u[...,0])
-			cdifu[...,-1]=2*(u[...,-1]-u[...,-2])
-		else:
-			cdifu[...,0]=(u[...,1]-u[...,-1])
-			cdifu[...,-1]=(u[...,0]-u[...,-2])
-		# Meridional directions
-		cdifv[...,1:-1,:]=dummy[...,2:,:]-dummy[...,:-2,:]
-		cdifv[...,0,:]=2*(dummy[...,1,:]-dummy[...,0,:])
-		cdifv[...,-1,:]=2*(dummy[...,-1,:]-dummy[...,-2,:])
-		# Divide by the increments
-		cdifu=cdifu/2./self.dlon
-		cdifv=cdifv/2./self.dlat
-		# Now, divide by R*cos(lat)
-		dummy=cdifu+cdifv
-		dummy=dummy/self.clats[:,numpy.newaxis]
-		dummy=dummy/R
-		return dummy
-
-class VCURL:
+		# Multiply each row of the v component by cosine(lat), into a
+		# scratch buffer reused across calls
+		coswork=_cachedbuffer(self,"_coswork",v.shape)
+		numpy.multiply(v,self._clatcol,coswork)
+		# Centered differences for each of the fields; the meridional
+		# one goes into a second cached scratch buffer
+		cdifu=numpy.empty(u.shape,numpy.float64)
+		cdifv=_cachedbuffer(self,"_difwork",v.shape)
+		_centereddiff(u,cdifu,self.PBlon,axis=-1)
+		_centereddiff(coswork,cdifv,0,axis=-2)
+		# (du/(2 dlon) + dv/(2 dlat)) / (R cos(lat)) rearranged so the
+		# common factor is applied in one broadcasted in-place multiply
+		cdifv*=self.dlon/self.dlat
+		numpy.add(cdifu,cdifv,cdifu)
+		cdifu*=self._scales(R)[0]
+		return cdifu
+
+	def hdivergence_chunked(self,u,v,R=6.37e6,chunklen=32):
+		"""Horizontal divergence evaluated in chunks along the first axis
+
+		Intended for long time series: 'u' and 'v' only need to
+		support slicing along their first (time) dimension, so netCDF
+		variables or memory-mapped arrays can be streamed through the
+		kernel 'chunklen' records at a time.
+
+		Arguments and output match 'hdivergence'.
+		"""
+		theshape=(len(u),)+u[0].shape
+		rval=numpy.empty(theshape,numpy.float64)
+		for start in xrange(0,theshape[0],chunklen):
+			rval[start:start+chunklen]=self.hdivergence(
+				numpy.asarray(u[start:start+chunklen]),
+				numpy.asarray(v[start:start+chunklen]),
+				R
+			)
+		return rval
+
+class VCURL(_HOPERATOR):
 	"Vertical component of the curl vector"
-	def __init__(self,lats,lons,asdegrees=1,PBlon=0):
-		"""Constructor for the class VCURL 
-
-		Arguments:
-
-			'lats' -- Array of latitudes
-
-			'lons' -- Array of longitudes
-
-		Optional Arguments:
-
-			'asdegrees' -- Bit parameter indicating wether
-				'lats' and 'lons' are passed as degrees
-				(default, 1) or not (radians, 0).
-
-			'PBlon' -- Bit parameter indicating the
-				use of periodic boundary conditions in
-				longitude. Defaults to 0 (no PB).
-                """
-		# These are the latitude/longitude increments
-		if asdegrees:
-			self.dlon=deg2rad(lons[1]-lons[0])
-			self.dlat=deg2rad(lats[1]-lats[0])
-			# This array holds the cosine of the latitudes
-			self.clats=numpy.cos(deg2rad(lats))
-		else:
-			self.dlon=lons[1]-lons[0]
-			self.dlat=lats[1]-lats[0]
-			# This array holds the cosine of the latitudes
-			self.clats=numpy.cos(lats)
-		# Periodic boundaries in latitude/longitude
-		self.PBlon=PBlon
-
 	def vcurl(self,u,v,R=6.37e6):
 		"""Vertical component of the curl verctor 
 
@@ -228,28 +239,39 @@ class VCURL:
 			'R' -- The radius of the sphere. (Defaults to the
 				radius of the Earth 6.37e6)
 		"""
-		# Multiply each row of the U component by cosine(lat)
-		dummy=numpy.array(u)*self.clats[:,numpy.newaxis]
-		# Centered differences for each of the fields
-		cdifu=numpy.zeros(u.shape,numpy.float64)
-		cdifv=numpy.zeros(v.shape,numpy.float64)
-		# Longitudinal directions
-		cdifv[...,1:-1]=v[...,2:]-v[...,:-2]
-		if not self.PBlon:
-			cdifv[...,0]=2*(v[...,1]-v[...,0])
-			cdifv[...,-1]=2*(v[...,-1]-v[...,-2])
-		else:
-			cdifv[...,0]=(v[...,1]-v[...,-1])
-			cdifv[...,-1]=(v[...,0]-v[...,-2])
-		# Meridional directions
-		cdifu[...,1:-1,:]=dummy[...,2:,:]-dummy[...,:-2,:]
-		cdifu[...,0,:]=2*(dummy[...,1,:]-dummy[...,0,:])
-		cdifu[...,-1,:]=2*(dummy[...,-1,:]-dummy[...,-2,:])
-		# Divide by the increments
-		cdifu=cdifu/2./self.dlat
-		cdifv=cdifv/2./self.dlon
-		# Now, divide by R*cos(lat)
-		dummy=cdifv-cdifu
-		dummy=dummy/self.clats[:,numpy.newaxis]
-		dummy=dummy/R
-		return dummy
+		# Multiply each row of the U component by cosine(lat), into a
+		# scratch buffer reused across calls
+		coswork=_cachedbuffer(self,"_coswork",u.shape)
+		numpy.multiply(u,self._clatcol,coswork)
+		# Centered differences for each of the fields; the meridional
+		# one goes into a second cached scratch buffer
+		cdifv=numpy.empty(v.shape,numpy.float64)
+		cdifu=_cachedbuffer(self,"_difwork",u.shape)
+		_centereddiff(v,cdifv,self.PBlon,axis=-1)
+		_centereddiff(coswork,cdifu,0,axis=-2)
+		# (dv/(2 dlon) - du/(2 dlat)) / (R cos(lat)) rearranged so the
+		# common factor is applied in one broadcasted in-place multiply
+		cdifu*=self.dlon/self.dlat
+		numpy.subtract(cdifv,cdifu,cdifv)
+		cdifv*=self._scales(R)[0]
+		return cdifv
+
+	def vcurl_chunked(self,u,v,R=6.37e6,chunklen=32):
+		"""Vertical curl component evaluated in chunks along the first axis
+
+		Intended for long time series: 'u' and 'v' only need to
+		support slicing along their first (time) dimension, so netCDF
+		variables or memory-mapped arrays can be streamed through the
+		kernel 'chunklen' records at a time.
+
+		Arguments and output match 'vcurl'.
+		"""
+		theshape=(len(u),)+u[0].shape
+		rval=numpy.empty(theshape,numpy.float64)
+		for start in xrange(0,theshape[0],chunklen):
+			rval[start:start+chunklen]=self.vcurl(
+				numpy.asarray(u[start:start+chunklen]),
+				numpy.asarray(v[start:start+chunklen]),
+				R
+			)
+		return rval
@@ -56,7 +56,7 @@ class HDSEOFs:
   def VarianceFraction(self,svdfunc=numpy.linalg.svd):
     "Total variance fraction accounted for each principal mode"
     l=self.Eigenvalues(svdfunc,full_matrices=0)
-    return l/numpy.add.reduce(l)
+    return l/numpy.sum(l)
 
   def Eigenvectors(self,Neofs,pcscaling=0,
                    svdsolver=numpy.linalg.svd):
@@ -74,22 +74,38 @@ class HDSEOFs:
 
       'svdsolver' -- Routine to perform the SVD underlying decomposition.
                      Defaults to LinearAlgebra's singular_value_decomposition.
+
+    The returned array is cached and marked read-only, so repeated
+    calls with the same arguments share a buffer instead of reshaping
+    the eigenvector matrix each time.
     """
     if not self.ready:
       self.E,self.L,c=svdsolver(self.S,full_matrices=0)
       self.ready=1
+      self._eofcache={}
+    if pcscaling not in (0,1):
+      raise pex.ScalingError(pcscaling)
+    try:
+      cache=self._eofcache
+    except AttributeError:
+      cache=self._eofcache={}
+    try:
+      return cache[(Neofs,pcscaling)]
+    except KeyError:
+      pass
     if pcscaling == 0:
-      return ptools.deunshape(
-        self.E[:,:Neofs], 
+      rval=ptools.deunshape(
+        self.E[:,:Neofs],
         self.originalshape+(Neofs,)
       )
-    if pcscaling == 1:
-      return ptools.deunshape(
-        self.E[:,:Neofs] * numpy.sqrt(self.L)[NA,:Neofs], 
+    else:
+      rval=ptools.deunshape(
+        self.E[:,:Neofs] * numpy.sqrt(self.L)[NA,:Neofs],
         self.originalshape+(Neofs,)
       )
-    else:
-      raise pex.ScalingError(pcscaling) 
+    rval.setflags(write=False)
+    cache[(Neofs,pcscaling)]=rval
+    return rval
 
   def Average(self):
     "Time average of the original field"
@@ -97,27 +113,76 @@ class HDSEOFs:
 
   def ScatteringMeasure(self):
     "Covariance or correlation matrix depending on the constructor"
-    return self.S
+    try:
+      return self.S
+    except AttributeError:
+      # Gram-path construction: S was never materialised, but every
+      # nonzero eigenpair is at hand, so it is recovered exactly here
+      self.S=numpy.dot(self.E*self.L[NA,:],numpy.transpose(self.E))
+      return self.S
+
+  def _gramBuild(self,iterator):
+    """Covariance-free construction for fewer records than items
+
+    With less records than items the scatter matrix has at most
+    'records' nonzero eigenvalues, so building its items x items
+    storage is redundant. This path loads the (records, items) data
+    matrix instead -- the smaller object in this regime --
+    eigendecomposes the (records, records) Gram matrix of the
+    residuals and recovers the EOFs with one matrix product.
+    """
+    X=numpy.empty((self.records,self.items),'d')
+    j=0
+    for i in self.therecords:
+      X[j]=numpy.ravel(iterator[i])
+      j=j+1
+    self.average=numpy.sum(X,axis=0)/self.records
+    numpy.subtract(X,self.average[NA,:],X)
+    if self.corrmatrix:
+      stds=numpy.sqrt(numpy.sum(X*X,axis=0)/float(self.records))
+      numpy.divide(X,stds[NA,:],X)
+    G=numpy.dot(X,numpy.transpose(X))/float(self.records)
+    w,V=numpy.linalg.eigh(G)
+    # eigh returns ascending eigenvalues; the EOF convention is
+    # descending, and rounding may leave tiny negative values
+    w=w[::-1]
+    V=V[:,::-1]
+    w=numpy.where(numpy.less(w,0.),0.,w)
+    safew=numpy.where(numpy.equal(w,0.),1.,w)
+    # If G v = lambda v then X^t v / sqrt(records*lambda) is a unit
+    # eigenvector of the scatter matrix for the same eigenvalue
+    self.E=numpy.dot(numpy.transpose(X),V)/ \
+           numpy.sqrt(safew*self.records)[NA,:]
+    self.L=w
+    self.average=self.average.astype(self.typecode)
+    self.ready=1
 
   def PCs(self,Neofs,iterator,irecord,pcscaling=0):
     "Principal components"
     self._forceReady()
     anomaly=numpy.ravel(iterator[irecord])-self.average
     if pcscaling == 0:
-      return numpy.add.reduce(anomaly[:,NA]*self.E[:,:Neofs])
+      return numpy.dot(anomaly,self.E[:,:Neofs])
     if pcscaling == 1:
-      return numpy.ravel(
-        numpy.add.reduce(anomaly[:,NA]*self.E[:,:Neofs]) /
-        numpy.sqrt(self.L)[NA,:Neofs]
-      )
+      return numpy.dot(anomaly,self.E[:,:Neofs])/numpy.sqrt(self.L[:Neofs])
     else:
       raise pex.ScalingError(pcscaling)
 
   def WholePCs(self,Neofs,iterator,pcscaling=0):
     "Principal components for all records"
-    rval=numpy.zeros((self.records,Neofs),'d')
+    if pcscaling not in (0,1):
+      raise pex.ScalingError(pcscaling)
+    self._forceReady()
+    # All the anomalies are projected at once with a single matrix
+    # product instead of one Python-level projection per record
+    anoms=numpy.empty((self.records,self.items),'d')
+    j=0
     for i in self.therecords:
-      rval[i,:]=self.PCs(Neofs,iterator,i,pcscaling)
+      numpy.subtract(numpy.ravel(iterator[i]),self.average,anoms[j])
+      j=j+1
+    rval=numpy.dot(anoms,self.E[:,:Neofs])
+    if pcscaling == 1:
+      rval=rval/numpy.sqrt(self.L[NA,:Neofs])
     return rval
 
   def NorthTest(self):
@@ -142,7 +207,8 @@ class SIHDSEOFs(HDSEOFs):
 
   Covariance matrix is obtained iterating once over the dataset.
   """
-  def __init__(self,iterator,tcode='d',therecords=None,corrmatrix=0):
+  def __init__(self,iterator,tcode='d',therecords=None,corrmatrix=0,
+               blocklen=64):
     """Constructor for the class 'SIHDSEOFs'
 
     Arguments:
@@ -152,15 +218,18 @@ class SIHDSEOFs(HDSEOFs):
 
     Optional arguments:
 
-      'tcode' -- numpy typecode for the internal computations. 
+      'tcode' -- numpy typecode for the internal computations.
                  Defaults to 'Float64'.
 
-      'therecords' -- List of records to be taken. Defaults to the 
+      'therecords' -- List of records to be taken. Defaults to the
                       whole data set.
 
-      'corrmatrix' -- Bit parameter indicating wether covariance matrix 
+      'corrmatrix' -- Bit parameter indicating wether covariance matrix
                       EOFs are computed (default, 0) or correlation matrix ones
                       (corrmatrix=1).
+
+      'blocklen' -- Number of records buffered together for the scatter
+                    matrix accumulation. Defaults to 64.
     """
     self.originalshape=iterator[0].shape
     self.ashape=numpy.array(self.originalshape,'i')
@@ -170,34 +239,65 @@ class SIHDSEOFs(HDSEOFs):
     else:
       self.records=len(therecords)
       self.therecords=therecords
-    self.items=numpy.multiply.reduce(self.ashape)
+    self.items=numpy.prod(self.ashape)
     self.typecode=tcode
     self.corrmatrix=corrmatrix
+    if self.records<self.items:
+      # Fewer records than items: the (records, records) Gram matrix
+      # route is smaller and faster, and still a single iteration
+      self._gramBuild(iterator)
+      return
     self.average=numpy.zeros((self.items,),self.typecode)
     self.S=numpy.zeros((self.items,self.items),self.typecode)
+    # The records are buffered 'blocklen' at a time so that each block
+    # contributes to S with a single matrix product (one BLAS call)
+    # instead of 'blocklen' separate rank-1 updates
+    buf=numpy.empty((min(blocklen,self.records),self.items),self.typecode)
+    nbuf=0
     for i in self.therecords:
-      field=numpy.ravel(iterator[i]) 
-      numpy.add(self.average,field,self.average)
-      numpy.add(self.S,numpy.multiply.outer(field,field),self.S)
+      buf[nbuf]=numpy.ravel(iterator[i])
+      nbuf=nbuf+1
+      if nbuf==len(buf):
+        numpy.add(self.average,numpy.sum(buf,axis=0),self.average)
+        numpy.add(self.S,numpy.dot(numpy.transpose(buf),buf),self.S)
+        nbuf=0
+    if nbuf:
+      part=buf[:nbuf]
+      numpy.add(self.average,numpy.sum(part,axis=0),self.average)
+      numpy.add(self.S,numpy.dot(numpy.transpose(part),part),self.S)
     ##################################################
     # Force the use of Float64 in S
     #################################################
     numpy.multiply(self.average,1.0/self.records,self.average).astype(self.typecode)
     numpy.multiply(self.S,1.0/float(self.records),self.S)
-    numpy.add(self.S,-numpy.multiply.outer(self.average,self.average),self.S)
+    # Subtract the mean outer product in place reusing the record
+    # buffer as scratch, so no (items, items) temporary is allocated
+    for i0 in xrange(0,self.items,len(buf)):
+      rows=min(len(buf),self.items-i0)
+      numpy.multiply(self.average[i0:i0+rows,NA],self.average[NA,:],
+                     buf[:rows])
+      numpy.subtract(self.S[i0:i0+rows],buf[:rows],self.S[i0:i0+rows])
     if self.corrmatrix:
-      stds=numpy.diagonal(self.S)
-      stds=numpy.sqrt(stds)
-      numpy.multiply(self.S,1./numpy.multiply.outer(stds,stds),self.S)
+      stds=numpy.sqrt(numpy.diagonal(self.S))
+      # Two broadcasted in-place divides instead of 1/outer(stds,stds),
+      # which would build two more (items, items) temporaries
+      numpy.divide(self.S,stds[:,NA],self.S)
+      numpy.divide(self.S,stds[NA,:],self.S)
     self.ready=0
 
 
 class DIHDSEOFs(HDSEOFs):
   """Double iteration huge data set EOFs
 
-  Covariance matrix is obtained iterating twice over the dataset.
+  Historically the covariance matrix was obtained iterating twice over
+  the dataset (mean first, residuals second). It is now accumulated in
+  a single pass over records shifted by the first one, which keeps the
+  cancellation error of a one-pass covariance in check while halving
+  the IO -- usually the real cost for huge datasets. The results are
+  the same; the name is kept for backwards compatibility.
   """
-  def __init__(self,iterator,tcode='d',therecords=None,corrmatrix=0):
+  def __init__(self,iterator,tcode='d',therecords=None,corrmatrix=0,
+               blocklen=64):
     """Constructor for the class 'DIHDSEOFs'
 
     Arguments:
@@ -207,15 +307,18 @@ class DIHDSEOFs(HDSEOFs):
 
     Optional arguments:
 
-      'tcode' -- numpy typecode for the internal computations. 
+      'tcode' -- numpy typecode for the internal computations.
                  Defaults to 'Float64'.
 
-      'therecords' -- List of records to be taken. Defaults to the 
+      'therecords' -- List of records to be taken. Defaults to the
                       whole data set.
 
-      'corrmatrix' -- Bit parameter indicating wether covariance matrix 
+      'corrmatrix' -- Bit parameter indicating wether covariance matrix
                       EOFs are computed (default, 0) or correlation matrix ones
                       (corrmatrix=1).
+
+      'blocklen' -- Number of records buffered together for the scatter
+                    matrix accumulation. Defaults to 64.
     """
     self.originalshape=iterator[0].shape
     self.ashape=numpy.array(self.originalshape,'i')
@@ -226,24 +329,148 @@ class DIHDSEOFs(HDSEOFs):
     else:
       self.records=len(therecords)
       self.therecords=therecords
-    self.items=numpy.multiply.reduce(self.ashape)
+    self.items=numpy.prod(self.ashape)
     self.typecode=tcode
     self.corrmatrix=corrmatrix
-    self.average=numpy.zeros((self.items,),self.typecode)
-    for i in self.therecords:
-      self.average=self.average+numpy.ravel(iterator[i])
-    self.average=(self.average/self.records).astype(self.typecode)
+    if self.records<self.items:
+      # Fewer records than items: the (records, records) Gram matrix
+      # route is smaller and faster, and needs a single iteration too
+      self._gramBuild(iterator)
+      return
+    # One blocked pass accumulates the records shifted by the first
+    # one: with d_i = field_i - field_0 the covariance follows from
+    # S = E[d d^t] - mean_d mean_d^t, and the shift keeps the
+    # cancellation error comparable to the old residual-based pass
+    buf=numpy.empty((min(blocklen,self.records),self.items),'d')
+    shift=numpy.ravel(iterator[self.therecords[0]]).astype('d')
+    self.average=numpy.zeros((self.items,),'d')
     self.S=numpy.zeros((self.items,self.items),'d')
+    nbuf=0
     for i in self.therecords:
-      residual=numpy.ravel(iterator[i])-self.average
-      numpy.add(self.S,numpy.multiply.outer(residual,residual),self.S)
+      numpy.subtract(numpy.ravel(iterator[i]),shift,buf[nbuf])
+      nbuf=nbuf+1
+      if nbuf==len(buf):
+        numpy.add(self.average,numpy.sum(buf,axis=0),self.average)
+        numpy.add(self.S,numpy.dot(numpy.transpose(buf),buf),self.S)
+        nbuf=0
+    if nbuf:
+      part=buf[:nbuf]
+      numpy.add(self.average,numpy.sum(part,axis=0),self.average)
+      numpy.add(self.S,numpy.dot(numpy.transpose(part),part),self.S)
     ##################################################
     # Force the use of Float64 in S
     #################################################
+    numpy.multiply(self.average,1./self.records,self.average)
     numpy.multiply(self.S,1./float(self.records),self.S)
+    # Subtract the shifted-mean outer product in place, reusing the
+    # record buffer as scratch just like SIHDSEOFs does
+    for i0 in xrange(0,self.items,len(buf)):
+      rows=min(len(buf),self.items-i0)
+      numpy.multiply(self.average[i0:i0+rows,NA],self.average[NA,:],
+                     buf[:rows])
+      numpy.subtract(self.S[i0:i0+rows],buf[:rows],self.S[i0:i0+rows])
+    # Undo the shift in the stored time average
+    numpy.add(self.average,shift,self.average)
+    self.average=self.average.astype(self.typecode)
     if self.corrmatrix:
-      stds=numpy.diagonal(self.S)
-      stds=numpy.sqrt(stds)
-      numpy.multiply(self.S,1./numpy.multiply.outer(stds,stds),self.S)
+      stds=numpy.sqrt(numpy.diagonal(self.S))
+      # Two broadcasted in-place divides instead of 1/outer(stds,stds),
+      # which would build two more (items, items) temporaries
+      numpy.divide(self.S,stds[:,NA],self.S)
+      numpy.divide(self.S,stds[NA,:],self.S)
     self.ready=0
 
+
+class RandSVDHDSEOFs(HDSEOFs):
+  """Randomized single iteration huge data set EOFs
+
+  The leading EOFs are approximated from a random sketch accumulated
+  during one iteration over the dataset. The (items, items) covariance
+  matrix is never built, so the memory footprint is of order
+  items*(neofs+oversampling) and fields with very many grid points can
+  be handled. Only the 'neofs' leading modes are recovered; their
+  accuracy rests on the usual randomized low-rank argument, so a few
+  extra 'oversampling' columns are carried through the sketch.
+  """
+  def __init__(self,iterator,neofs,oversampling=10,tcode='d',
+               therecords=None,blocklen=64):
+    """Constructor for the class 'RandSVDHDSEOFs'
+
+    Arguments:
+
+      'iterator' -- Indexable object (e.g. Numpy array, nciterator object, ...)
+                    to decompose into EOFs
+
+      'neofs' -- Number of leading EOFs to recover
+
+    Optional arguments:
+
+      'oversampling' -- Extra random sketch columns beyond 'neofs'.
+                        Defaults to 10.
+
+      'tcode' -- numpy typecode for the internal computations.
+                 Defaults to 'Float64'.
+
+      'therecords' -- List of records to be taken. Defaults to the
+                      whole data set.
+
+      'blocklen' -- Number of records buffered together for the sketch
+                    accumulation. Defaults to 64.
+    """
+    self.originalshape=iterator[0].shape
+    self.ashape=numpy.array(self.originalshape,'i')
+    if not therecords:
+      self.records=len(iterator)
+      self.therecords=range(self.records)
+    else:
+      self.records=len(therecords)
+      self.therecords=therecords
+    self.items=numpy.prod(self.ashape)
+    self.typecode=tcode
+    self.neofs=neofs
+    ell=min(neofs+oversampling,self.items)
+    Omega=numpy.random.standard_normal((self.items,ell))
+    # One pass accumulates the mean and Z = (X^t X) Omega, each block
+    # contributing through two matrix products; the covariance sketch
+    # S Omega is recovered below from Z and the mean alone
+    Z=numpy.zeros((self.items,ell),'d')
+    self.average=numpy.zeros((self.items,),'d')
+    buf=numpy.empty((min(blocklen,self.records),self.items),'d')
+    nbuf=0
+    for i in self.therecords:
+      buf[nbuf]=numpy.ravel(iterator[i])
+      nbuf=nbuf+1
+      if nbuf==len(buf):
+        numpy.add(self.average,numpy.sum(buf,axis=0),self.average)
+        numpy.add(Z,numpy.dot(numpy.transpose(buf),numpy.dot(buf,Omega)),Z)
+        nbuf=0
+    if nbuf:
+      part=buf[:nbuf]
+      numpy.add(self.average,numpy.sum(part,axis=0),self.average)
+      numpy.add(Z,numpy.dot(numpy.transpose(part),numpy.dot(part,Omega)),Z)
+    numpy.multiply(self.average,1.0/self.records,self.average)
+    numpy.multiply(Z,1.0/float(self.records),Z)
+    Y=Z-numpy.outer(self.average,numpy.dot(self.average,Omega))
+    # Nystrom reconstruction of the sketched covariance: with the
+    # stabilising shift nu, S ~ Ynu (Omega^t Ynu)^+ Ynu^t, whose
+    # eigenpairs follow from the SVD of the thin factor F
+    nu=numpy.finfo('d').eps*numpy.sqrt(float(self.items))* \
+       numpy.sqrt(numpy.sum(Y*Y))
+    Ynu=Y+nu*Omega
+    C=numpy.dot(numpy.transpose(Omega),Ynu)
+    C=(C+numpy.transpose(C))/2.
+    F=numpy.transpose(numpy.linalg.solve(numpy.linalg.cholesky(C),
+                                         numpy.transpose(Ynu)))
+    U,sigma,c=numpy.linalg.svd(F,full_matrices=0)
+    lambdas=sigma*sigma-nu
+    lambdas=numpy.where(numpy.less(lambdas,0.),0.,lambdas)
+    self.E=U[:,:neofs]
+    self.L=lambdas[:neofs]
+    self.ready=1
+
+  def ScatteringMeasure(self):
+    "Unavailable here: this constructor never builds the scatter matrix"
+    raise NotImplementedError(
+      "RandSVDHDSEOFs does not build the covariance matrix"
+    )
+
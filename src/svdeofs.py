@@ -30,6 +30,14 @@
 # 
 
 import numpy
+try:
+  from scipy.linalg import lapack as _lapack
+except ImportError:
+  _lapack = None
+try:
+  from concurrent import futures as _futures
+except ImportError:
+  _futures = None
 import pyclimate.pydcdflib
 import pyclimate.mctest
 import pyclimate.mvarstatools
@@ -38,15 +46,59 @@ import pyclimate.tools
 import sys
 
 NA = numpy.newaxis
-def mm(array1,array2):
-  print 'mming:',array1.shape,array2.shape
-  return numpy.matrix(array1)*numpy.matrix(array2)
 SVD = numpy.linalg.svd
 ptools = pyclimate.tools
 pmvstools = pyclimate.mvarstatools
 mctest = pyclimate.mctest
 pex = pyclimate.pyclimateexcpt
 
+def _datamatrixsvd(residual):
+  """SVD of the centered data matrix through its cheapest route
+
+  For strongly rectangular matrices (many more channels than samples,
+  or the other way around) the same factors are recovered much faster
+  from the eigendecomposition of the small Gram matrix plus one matrix
+  product than from the SVD of the full matrix, whose cost grows with
+  the larger dimension. Near-square matrices keep the plain SVD.
+  Returns the same '(A, Lh, Et)' tuple as 'SVD(residual,full_matrices=0)'
+  up to the sign of each mode, which is arbitrary anyway.
+  """
+  n,m = residual.shape
+  if min(n,m)*4 >= max(n,m):
+    if _lapack is not None and \
+       residual.dtype in (numpy.float32,numpy.float64):
+      # The gesdd driver called directly: the centered matrix is
+      # scratch by this point, so it can be factorised in place
+      # without the extra copy numpy.linalg.svd always takes
+      if residual.dtype == numpy.float32:
+        gesdd = _lapack.sgesdd
+      else:
+        gesdd = _lapack.dgesdd
+      A,Lh,Et,info = gesdd(residual,compute_uv=1,
+                           full_matrices=0,overwrite_a=1)
+      if info == 0:
+        return A,Lh,Et
+    return SVD(residual,full_matrices=0)
+  if n < m:
+    G = numpy.dot(residual,numpy.transpose(residual))
+  else:
+    G = numpy.dot(numpy.transpose(residual),residual)
+  w,V = numpy.linalg.eigh(G)
+  # eigh returns the eigenvalues in ascending order; the EOF convention
+  # is descending, and rounding may leave tiny negative values
+  w = w[::-1]
+  V = V[:,::-1]
+  Lh = numpy.sqrt(numpy.where(numpy.less(w,0.),0.,w))
+  # Guard exactly null singular values when recovering the other factor
+  safeLh = numpy.where(numpy.equal(Lh,0.),1.,Lh)
+  if n < m:
+    A = V
+    Et = numpy.transpose(numpy.dot(numpy.transpose(residual),V)/safeLh[NA,:])
+  else:
+    A = numpy.dot(residual,V)/safeLh[NA,:]
+    Et = numpy.transpose(V)
+  return A,Lh,Et
+
 # Derive the EOFs from a dataset by means of the SVD decomposition of the
 # data matrix (See Jackson, 1991 and Preisendorfer, 1987), avoiding the
 # problems associated to a singular correlation matrix
@@ -56,18 +108,25 @@ pex = pyclimate.pyclimateexcpt
 # If p=min(n,m) the output dimensions are: pcs(nxp)
 #                                          L  (pxp)
 #                                          E  (mxp)
-def svdeofs(dataset, pcscaling=0):
+def svdeofs(dataset, pcscaling=0, dtype='d'):
   """Calculates de EOF decomposition of a field.
-  
+
   Arguments:
 
-    'dataset' -- NumPy array containing the field to be decomposed. 
+    'dataset' -- NumPy array containing the field to be decomposed.
                  First dimension must be time.
 
-    'pcscaling' -- sets the scale factor of the PCs: 0 means eigenvalues 
-                   are PC variances and the EOFs are orthonormal. 1 means 
+    'pcscaling' -- sets the scale factor of the PCs: 0 means eigenvalues
+                   are PC variances and the EOFs are orthonormal. 1 means
                    PCs with unit variance and orthogonal EOFs. (Defaults to 0)
 
+    'dtype' -- typecode the decomposition is carried out in. Defaults
+               to float64; pass 'f' to factorise in single precision,
+               which halves the memory traffic and roughly doubles the
+               SVD throughput at the cost of ~7 significant digits --
+               usually plenty for the leading modes of a climate
+               field. The eigenvalues are returned as float64 anyway.
+
   Returns a tuple containing: PCs, eigenvalues, EOFs
 
   If the field has more than one spatial dimension it can be processed anyway
@@ -81,7 +140,8 @@ def svdeofs(dataset, pcscaling=0):
   has_nan = ptools.checkvalidnans(residual)
   if has_nan:
       residual, cols = ptools.removenans(residual)
-  A,Lh,E = SVD(residual,full_matrices=0)
+  residual = residual.astype(dtype, copy=False)
+  A,Lh,E = _datamatrixsvd(residual)
   # The eigenvalues from SVD routines are powered to 1/2, thus: square
   # the vector.
   # Moreover, in order to be able to compare these eigenvalues to the 
@@ -96,7 +156,10 @@ def svdeofs(dataset, pcscaling=0):
   # A "-1" appeared here before version 1.1
   # (it has been removed for consistency)
   normfactor = float(len(residual))
-  L = Lh*Lh/normfactor
+  # Square in float64 so the eigenvalues keep full precision even on
+  # the single precision path
+  Lh64 = Lh.astype('d')
+  L = Lh64*Lh64/normfactor
   # E is returned transposed
   E = numpy.transpose(E)
   pcs = A*Lh
@@ -107,7 +170,6 @@ def svdeofs(dataset, pcscaling=0):
   elif pcscaling == 1:
     # E orthogonal but not orthonormal
     # unity pc variances
-    print E.shape,L.shape
     E = E * numpy.sqrt(L)[NA,:]
     pcs = pcs / numpy.sqrt(L)[NA,:]
   else:
@@ -118,6 +180,30 @@ def svdeofs(dataset, pcscaling=0):
     E = ptools.deunshape(E, oldshape[1:]+E.shape[-1:])
   return pcs,L,E
 
+def _randomizedeofs(residual, neofs, oversampling=10, nit=2):
+  """Leading EOFs of a centered data matrix by randomized partial SVD
+
+  The Monte Carlo congruence test only feeds the 'neofs' leading EOFs
+  of each subsample to the congruence coefficient, so the full SVD is
+  wasted there. A randomized range finder with a couple of subspace
+  iterations captures the leading right singular vectors at a cost
+  proportional to 'neofs' instead of the small matrix dimension. Small
+  matrices fall through to the exact route.
+  """
+  n,m = residual.shape
+  ell = min(neofs+oversampling,n,m)
+  if ell >= min(n,m):
+    return numpy.transpose(_datamatrixsvd(residual)[2])[:,:neofs]
+  Q = numpy.linalg.qr(
+    numpy.dot(residual,numpy.random.standard_normal((m,ell)))
+  )[0]
+  for it in xrange(nit):
+    Q = numpy.linalg.qr(numpy.dot(numpy.transpose(residual),Q))[0]
+    Q = numpy.linalg.qr(numpy.dot(residual,Q))[0]
+  B = numpy.dot(numpy.transpose(Q),residual)
+  c,s,Et = SVD(B,full_matrices=0)
+  return numpy.transpose(Et)[:,:neofs]
+
 def getgencol(a, ncol=0):
   return a[...,ncol]
 
@@ -137,10 +223,11 @@ def pcseriescorrelation(pcs, eofs, dataset):
   original time series with each PC.
   """
   residual = pmvstools.center(dataset)
-  datastd = numpy.add.reduce(residual*residual) / float(len(residual))
+  # Fused sum of squares over time: no residual-sized temporary
+  datastd = numpy.einsum('i...,i...->...',residual,residual) / float(len(residual))
   datastd = numpy.sqrt(datastd)
-  pcsstd = numpy.sqrt(numpy.add.reduce(pcs*pcs) / float(len(pcs)))
-  return eofs * pcsstd / datastd[...,NA] 
+  pcsstd = numpy.sqrt(numpy.einsum('ij,ij->j',pcs,pcs) / float(len(pcs)))
+  return eofs * pcsstd / datastd[...,NA]
 
 def eofsasexplainedvariance(eofs,pcscaling=0,lambdas=None):
   #e# NewAxis y multidimensionalidad ALTAMENTE DUDOSA
@@ -155,34 +242,40 @@ def eofsasexplainedvariance(eofs,pcscaling=0,lambdas=None):
     rval = eofs * eofs * lambdas[NA,:] 
   if not pcscaling in [0,1]:
     raise pex.ScalingError(pcscaling)    
-  totvar = numpy.add.reduce(rval, -1)
+  totvar = numpy.sum(rval, axis=-1)
   return rval / totvar[...,NA]
 
 def getvariancefraction(lambdas):
-  return lambdas/numpy.add.reduce(lambdas)
+  return lambdas/numpy.sum(lambdas)
 
-def bartletttest(lambdas,samples):
+def _bartlettchis(lambdas,samples):
+  """Vectorised Bartlett statistics and the null-eigenvalue mask
+
+  Shared by the module level 'bartletttest' and the 'SVDEOFs' method.
+  The tail reductions over 'lambdas[k:]' are reverse cumulative sums
+  computed once, so the whole statistic array is a single expression.
+  """
   p = len(lambdas)
-  theshape = (p-1,)
-  chis = numpy.zeros(theshape,'d')
-  pchis = numpy.zeros(theshape,'d')
   nu = samples - 1
   # This test will fail when lambda[i]<=0!!!
   mask = numpy.less_equal(lambdas,0.0)
   maskedlambdas = lambdas * numpy.logical_not(mask) + mask
-  loglambdas = numpy.log(maskedlambdas)
+  tailsum = numpy.cumsum(maskedlambdas[::-1])[::-1]
+  taillogsum = numpy.cumsum(numpy.log(maskedlambdas)[::-1])[::-1]
+  pk = numpy.arange(p,1,-1).astype('d')
+  chis = nu * (pk*numpy.log(tailsum[:-1]/pk) - taillogsum[:-1])
+  return numpy.where(mask[:-1],0.0,chis),mask
+
+def bartletttest(lambdas,samples):
+  p = len(lambdas)
+  chis,mask = _bartlettchis(lambdas,samples)
+  pchis = numpy.zeros((p-1,),'d')
   for k in xrange(p-1):
-    cdf = .5*(p-k-1)*(p-k+2)
     if mask[k] == 1:
       # "Transformed" eigenvalues, set a probability of 1
-      pchis = pchis * numpy.logical_not(mask) + mask
-      chis[k] = 0.0
+      pchis[k] = 1.0
     else:
-      chis[k] = nu * (
-        (p-k) * numpy.log(numpy.add.reduce(maskedlambdas[k:])/(p-k))
-        - numpy.add.reduce(loglambdas[k:])
-      )
-      pchis[k] = getchiprob(chis[k],cdf)
+      pchis[k] = getchiprob(chis[k],.5*(p-k-1)*(p-k+2))
   return (chis,pchis)
 
 def getchiprob(chival,dof):
@@ -215,46 +308,76 @@ def mctesteofs(dataset,eofs,subsamples,length):
   """
   eofnumber = eofs.shape[-1]
   theccoefs = numpy.zeros((subsamples,)+(eofnumber,),'d')
+  flateofs = numpy.reshape(eofs,(-1,eofnumber))
   for isample in xrange(subsamples):
     subslist = mctest.getrandomsubsample(length,len(dataset))
     subsample = numpy.take(dataset,subslist,0)
     z, lambdas, eofdot = svdeofs(subsample)
-    for ieof in xrange(eofnumber):
-      theccoefs[isample,ieof] = pmvstools.congruence(
-          numpy.ravel(eofdot[...,ieof]),
-          numpy.ravel(eofs[...,ieof])
-      )
+    # congruence is columnwise on 2-D input: all the EOFs at once
+    flatdot = numpy.reshape(eofdot,(-1,eofdot.shape[-1]))
+    theccoefs[isample,:] = pmvstools.congruence(flatdot[:,:eofnumber],flateofs)
   return theccoefs
 
+def _mcsvdeofssample(args):
+  """One subsample of the SVDEOFs Monte Carlo test (worker function)
+
+  Takes the whole argument tuple at once so it can be dispatched over
+  a process pool; each call is an independent subsample SVD plus one
+  congruence evaluation.
+  """
+  flatdata,subslist,neofs,thiseofs = args
+  sub = pmvstools.center(numpy.take(flatdata,subslist,axis=0))
+  if ptools.checkvalidnans(sub):
+    sub = ptools.removenans(sub)[0]
+  return pmvstools.congruence(_randomizedeofs(sub,neofs),thiseofs)
+
 ###########################################
 # New class implementation of the EOF routines...
 ####################################################
 class SVDEOFs:
   "Class implementation of the EOF routines"
-  def __init__(self, dataset):
+  def __init__(self, dataset, dtype='d'):
     """Contructor for 'SVDEOFs'
 
     Argument:
 
       'dataset' -- NumPy array containing the data to be decomposed. Time
-                   must be the first dimension. Several channel dimensions 
+                   must be the first dimension. Several channel dimensions
                    are supported.
+
+    Optional argument:
+
+      'dtype' -- typecode the decomposition is carried out in. Defaults
+                 to float64; pass 'f' to factorise in single precision
+                 (half the memory traffic, roughly double the SVD
+                 throughput, ~7 significant digits). The eigenvalues
+                 are stored as float64 either way.
     """
     self.dataset = dataset
+    # Flat (records, channels) view of the data, shared by the
+    # projection methods instead of reshaping the dataset on each call
+    self._flatdata = ptools.unshape(dataset)[0]
     self.originalshape = dataset[0].shape
-    self.channels = numpy.multiply.reduce(numpy.array(self.originalshape))
+    self.channels = numpy.prod(self.originalshape)
     self.records = len(dataset)
     self.field2d = len(dataset.shape)==2
     residual = pmvstools.center(dataset)
     if not self.field2d:
       residual = ptools.unshape(residual)[0]
     newshape = residual.shape
+    # Per-channel sums of squares of the anomalies, cached so methods
+    # scaling by the data variance need not recenter the whole dataset
+    self._colss = numpy.einsum('ij,ij->j',residual,residual)
     has_nan = ptools.checkvalidnans(residual)
     if has_nan:
         residual, cols = ptools.removenans(residual)
-    A,Lh,Et = SVD(residual,full_matrices=0)
+    residual = residual.astype(dtype, copy=False)
+    A,Lh,Et = _datamatrixsvd(residual)
     normfactor = float(len(residual))
-    self.L = self.lambdas = Lh*Lh/normfactor
+    # Square in float64 so the eigenvalues keep full precision even on
+    # the single precision path
+    Lh64 = Lh.astype('d')
+    self.L = self.lambdas = Lh64*Lh64/normfactor
     self.neofs = len(self.L)
     self.compactE = numpy.transpose(Et)
     if has_nan:
@@ -263,7 +386,10 @@ class SVDEOFs:
     else:
         self.flatE = self.compactE
     self.E = ptools.deunshape(self.flatE, self.originalshape+(self.neofs,))
-    self.P = A*Lh
+    # Fortran order so the leading-column slices taken by the projection
+    # methods stay contiguous and map onto a single GEMM with no copy
+    self.flatE = numpy.asfortranarray(self.flatE)
+    self.P = numpy.asfortranarray(A*Lh)
 
   def pcs(self, pcscaling=0):
     """Returns the principal components as the columns of an array
@@ -314,33 +440,41 @@ class SVDEOFs:
 
   def eofsAsCorrelation(self):
     "The EOFs scaled as the correlation of the PC with the original field"
-    residual = pmvstools.center(self.dataset)
-    datastd = numpy.add.reduce(residual*residual)/float(self.records)
+    datastd = ptools.deunshape(self._colss/float(self.records),
+                               self.originalshape)
     datastd = numpy.sqrt(datastd)
-    pcsstd = numpy.add.reduce(self.P*self.P)/float(self.records)
+    pcsstd = numpy.einsum('ij,ij->j',self.P,self.P)/float(self.records)
     pcsstd = numpy.sqrt(pcsstd)
-    return self.E * pcsstd / datastd[...,NA] 
+    return self.E * pcsstd / datastd[...,NA]
 
   def eofsAsExplainedVariance(self):
     "The EOFs scaled as fraction of explained variance of the original field"
     #e# NewAxis y multidimensionalidad ALTAMENTE DUDOSA
     rval = self.E * self.E 
-    totvar = numpy.add.reduce(rval, -1)
+    totvar = numpy.sum(rval, axis=-1)
     return rval/totvar[...,NA]
 
   def varianceFraction(self):
     "The fraction of the total variance explained by each principal mode"
-    return self.lambdas/numpy.add.reduce(self.lambdas)
+    return self.lambdas/numpy.sum(self.lambdas)
 
   def totalAnomalyVariance(self):
     "The total variance associated to the field of anomalies"
-    return numpy.add.reduce(self.lambdas)
+    return numpy.sum(self.lambdas)
 
-  def reconstructedField(self, neofs):
-    "Reconstructs the original field using 'neofs' EOFs"
-    rval = mm(self.P[:,:neofs], numpy.transpose(self.flatE[:,:neofs]))
-    rval = numpy.array(rval).reshape(self.dataset.shape)
-    return rval
+  def reconstructedField(self, neofs, out=None):
+    """Reconstructs the original field using 'neofs' EOFs
+
+    Optional argument:
+
+      'out' -- preallocated '(records, channels)' buffer of the right
+               typecode the flat reconstruction is written into, saving
+               a temporary when the method is called repeatedly.
+               Defaults to None (a fresh array is returned).
+    """
+    rval = numpy.dot(self.P[:,:neofs],
+                     numpy.transpose(self.flatE[:,:neofs]), out=out)
+    return rval.reshape(self.dataset.shape)
 
   def unreconstructedField(self,neofs,X=None):
     """Returns the part of the field NOT reconstructed by 'neofs' EOFs
@@ -354,23 +488,29 @@ class SVDEOFs:
       'X' -- The field to try to reconstruct. Defaults to the data field
              used to derive the EOFs.
     """
-    if X==None:
-        myX = self.dataset
+    rval = self.projectField(neofs, X)
+    if X is None:
+        Xdot = self._flatdata
+        oldshape = self.dataset.shape
     else:
-        myX = X
-    rval = self.projectField(neofs, myX)
-    oldshape = myX.shape
-    rval = ptools.unshape(myX)[0] - mm(rval, numpy.transpose(self.flatE[:,:neofs]))
+        Xdot = ptools.unshape(X)[0]
+        oldshape = X.shape
+    rval = numpy.dot(rval, numpy.transpose(self.flatE[:,:neofs]))
+    # Reuse the reconstruction buffer for the residual
+    numpy.subtract(Xdot, rval, rval)
     return ptools.deunshape(rval,oldshape)
 
-  def projectField(self,neofs,X=None):
-    "Projects a field 'X' onto the 'neofs' leading EOFs returning its coordinates in the EOF-space"
-    if X==None:
-        myX = self.dataset
+  def projectField(self,neofs,X=None,out=None):
+    """Projects a field 'X' onto the 'neofs' leading EOFs returning its coordinates in the EOF-space
+
+    The optional argument 'out' is a preallocated '(records, neofs)'
+    buffer of the right typecode the projection is written into.
+    """
+    if X is None:
+        Xdot = self._flatdata
     else:
-        myX = X
-    Xdot, oshape = ptools.unshape(myX)
-    return mm(Xdot[:,:],self.flatE[:,:neofs])
+        Xdot = ptools.unshape(X)[0]
+    return numpy.dot(Xdot,self.flatE[:,:neofs],out=out)
 
   def bartlettTest(self):
     """Performs the Bartlett test on the last p-k eigenvalues
@@ -395,27 +535,7 @@ class SVDEOFs:
 
       'chiprob' -- the probability associated to that 'chi' value
     """
-    p = self.neofs
-    theshape = (p-1,)
-    chis = numpy.zeros(theshape,'d')
-    pchis = numpy.zeros(theshape,'d')
-    nu = self.records-1
-    # This test will fail when lambda[i]<=0!!!
-    mask = numpy.less_equal(self.lambdas,0.0)
-    maskedlambdas = self.lambdas*numpy.logical_not(mask)+mask
-    loglambdas = numpy.log(maskedlambdas)
-    for k in xrange(p-1):
-      cdf = .5*(p-k-1)*(p-k+2)
-      if mask[k] == 1:
-        # "Transformed" eigenvalues, set a probability of 1
-        pchis = pchis*numpy.logical_not(mask)+mask
-        chis[k] = 0.0
-      else:
-        chis[k] = nu*((p-k)* \
-          numpy.log(numpy.add.reduce(maskedlambdas[k:])/(p-k)) \
-          -numpy.add.reduce(loglambdas[k:]))
-        pchis[k] = getchiprob(chis[k],cdf)
-    return (chis,pchis)
+    return bartletttest(self.lambdas,self.records)
 
   def northTest(self):
     """Performs the North test returning the estimated sampling errors
@@ -450,15 +570,46 @@ class SVDEOFs:
     """
     neofs = neofs or ptools.getneofs(self.lambdas)
     theccoefs = numpy.zeros((subsamples,neofs),'d')
+    thiseofs = self.compactE[...,:neofs]
+    if _futures is not None and subsamples >= 4:
+      # The subsamples are independent, so the SVDs run across a
+      # process pool (processes rather than threads: each worker calls
+      # into BLAS itself). Short runs stay serial below.
+      theargs = [
+        (self._flatdata,mctest.getrandomsubsample(length,self.records),
+         neofs,thiseofs)
+        for isample in xrange(subsamples)
+      ]
+      executor = _futures.ProcessPoolExecutor()
+      try:
+        for isample,ccoefs in enumerate(executor.map(_mcsvdeofssample,theargs)):
+          theccoefs[isample,:] = ccoefs
+      finally:
+        executor.shutdown()
+      return theccoefs
+    pool = ptools._MatrixPool()
     for isample in xrange(subsamples):
       subslist = mctest.getrandomsubsample(length,self.records)
-      SVDEOFsobj = SVDEOFs(numpy.take(self.dataset,subslist, axis=0))
-      eofdot = SVDEOFsobj.compactE[...,:neofs]
-      thiseofs = self.compactE[...,:neofs]
-      for ieof in xrange(neofs):
-        theccoefs[isample,ieof] = pmvstools.congruence(
-          eofdot[...,ieof],thiseofs[...,ieof]
-        )
+      # Only the leading EOFs of the subsample matter here, so a
+      # partial randomized SVD replaces the full SVDEOFs construction.
+      # The subsample is gathered straight into a pooled scratch
+      # buffer: no fresh (length, channels) allocation per iteration
+      subsample = pool.get((length,self._flatdata.shape[1]),
+                           self._flatdata.dtype.char)
+      numpy.take(self._flatdata,subslist,0,subsample)
+      if subsample.dtype == numpy.float64:
+        sub = subsample
+        numpy.subtract(sub,numpy.mean(sub,0),sub)
+      else:
+        # Integer or single precision data: center into a separate
+        # float64 pooled residual
+        sub = pool.get(subsample.shape)
+        numpy.subtract(subsample,numpy.mean(subsample,0),sub)
+      if ptools.checkvalidnans(sub):
+        sub = ptools.removenans(sub)[0]
+      eofdot = _randomizedeofs(sub,neofs)
+      # congruence is columnwise on 2-D input: all the EOFs at once
+      theccoefs[isample,:] = pmvstools.congruence(eofdot,thiseofs)
     return theccoefs
 
 if __name__ == "__main__":
@@ -469,7 +620,7 @@ if __name__ == "__main__":
     c = a-b
     c = c*c
     c = numpy.ravel(c)
-    c = numpy.add.reduce(c)
+    c = numpy.sum(c)
     c = numpy.sqrt(c)
     return c
   print "Testing new class: SVDEOFs"
@@ -391,3 +391,27 @@ class _TimeSeries:
 	def __len__(self):
 		"Lenght of the internal data"
 		return len(self.data)
+
+class _MatrixPool:
+	"""Small pool of scratch matrices keyed by shape and typecode
+
+	Loops that repeatedly need work arrays of the same size (like the
+	Monte Carlo resampling tests) rent them here instead of allocating
+	a fresh one every iteration. One borrower per key at a time.
+	"""
+	def __init__(self):
+		self.buffers={}
+
+	def get(self,shape,tcode='d'):
+		"Scratch array of the given shape, reused across calls"
+		key=(tuple(shape),tcode)
+		try:
+			return self.buffers[key]
+		except KeyError:
+			rval=numpy.empty(shape,tcode)
+			self.buffers[key]=rval
+			return rval
+
+	def clear(self):
+		"Drops every pooled buffer"
+		self.buffers={}